@@ -23,7 +23,7 @@ setup(
     long_description=read_file("README.md"),
     long_description_content_type="text/markdown",
     packages=["vcache"],
-    install_requires=["cacheout"],
+    extras_require={"lz4": ["lz4"]},
     license="MIT",
     classifiers=[
         "Programming Language :: Python",
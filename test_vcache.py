@@ -1,17 +1,32 @@
 # coding:utf-8
 
+import os
+import pickle
+import threading
+import time
+import zlib
 import pytest
 from vcache import (
     Cache,
     Item,
     RedisIface,
     Option,
+    LocalCache,
     OTHER_SUFFIX,
     STR_SUFFIX,
     BYTES_SUFFIX,
+    INT_SUFFIX,
+    FLOAT_SUFFIX,
+    BOOL_SUFFIX,
+    PICKLE_BUFFERS_SUFFIX,
     NO_COMPRESSION,
     ZLIB_COMPRESSION,
+    ZLIB_RAW_COMPRESSION,
+    LZ4_COMPRESSION,
+    lz4_frame,
     CacheMissError,
+    encode_time,
+    decode_time,
     RedisLocalCacheNoneError,
 )
 
@@ -21,6 +36,94 @@ def cache():
     return Cache()
 
 
+class DictRedis(RedisIface):
+    def __init__(self):
+        self.data = {}
+
+    def set(self, key, value, expiration):
+        self.data[key] = value
+
+    def setxx(self, key, value, expiration):
+        if key in self.data:
+            self.data[key] = value
+
+    def setnx(self, key, value, expiration):
+        if key not in self.data:
+            self.data[key] = value
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def delete(self, *key):
+        return sum(1 for k in key if self.data.pop(k, None) is not None)
+
+
+class MappingMsetRedis:
+    """Mimics redis-py without pipelines: mset takes a mapping, no ttl."""
+
+    def __init__(self):
+        self.data = {}
+
+    def set(self, name, value, ex=None):
+        self.data[name] = value
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def mset(self, mapping):
+        self.data.update(mapping.items())
+
+
+class PyRedisLike(MappingMsetRedis):
+    def __init__(self):
+        super(PyRedisLike, self).__init__()
+        self.executed = 0
+
+    def pipeline(self):
+        return PyRedisLikePipeline(self)
+
+
+class PyRedisLikePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, name, value, ex=None):
+        self.commands.append((name, value, ex))
+
+    def execute(self):
+        for name, value, ex in self.commands:
+            self.client.set(name, value, ex)
+        self.client.executed += 1
+
+
+@pytest.fixture
+def redis_cache():
+    return Cache(Option(redis=DictRedis(), stats_enabled=True))
+
+
+class ZeroCopyByteArray(bytearray):
+    def __reduce_ex__(self, protocol):
+        return type(self)._reconstruct, (pickle.PickleBuffer(self),), None
+
+    @classmethod
+    def _reconstruct(cls, obj):
+        return cls(obj)
+
+
+class BufferView:
+    """Rebuilds on top of the unpickled buffer, like numpy.frombuffer."""
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+
+    def __reduce_ex__(self, protocol):
+        return type(self), (pickle.PickleBuffer(self.view),)
+
+
 class Foo:
     def __init__(self, val):
         self.val = val
@@ -72,8 +175,29 @@ def test_marshal_bytes(cache):
 def test_marshal_int(cache):
     v = 1
     b = cache.marshal(v)
+    assert b[-1:] == INT_SUFFIX
+    assert len(b) == 9
+
+
+def test_marshal_big_int(cache):
+    v = 1 << 64
+    b = cache.marshal(v)
     assert b[-1:] == OTHER_SUFFIX
-    assert b[-2:-1] == NO_COMPRESSION
+    assert cache.unmarshal(b) == v
+
+
+def test_marshal_float(cache):
+    v = 1.5
+    b = cache.marshal(v)
+    assert b[-1:] == FLOAT_SUFFIX
+    assert cache.unmarshal(b) == v
+
+
+@pytest.mark.parametrize("v", [True, False])
+def test_marshal_bool(cache, v):
+    b = cache.marshal(v)
+    assert b[-1:] == BOOL_SUFFIX
+    assert cache.unmarshal(b) is v
 
 
 def test_marshal_tuple(cache):
@@ -110,7 +234,51 @@ def test_marshal_long_value(cache):
     v = [1] * 1000
     b = cache.marshal(v)
     assert b[-1:] == OTHER_SUFFIX
-    assert b[-2:-1] == ZLIB_COMPRESSION
+    if lz4_frame is not None:
+        assert b[-2:-1] == LZ4_COMPRESSION
+    else:
+        assert b[-2:-1] == ZLIB_RAW_COMPRESSION
+    assert cache.unmarshal(b) == v
+
+
+def test_unmarshal_zlib_value(cache):
+    v = [1] * 1000
+    b = zlib.compress(pickle.dumps(v)) + ZLIB_COMPRESSION + OTHER_SUFFIX
+    assert cache.unmarshal(b) == v
+
+
+def test_marshal_incompressible_value(cache):
+    v = os.urandom(1000)
+    b = cache.marshal((v,))
+    assert b[-1:] == OTHER_SUFFIX
+    assert b[-2:-1] == NO_COMPRESSION
+    assert cache.unmarshal(b) == (v,)
+
+
+def test_marshal_out_of_band_buffers(cache):
+    v = {"data": ZeroCopyByteArray(os.urandom(4096)), "rows": [1] * 1000}
+    b = cache.marshal(v)
+    assert b[-1:] == PICKLE_BUFFERS_SUFFIX
+    assert b[-2:-1] != NO_COMPRESSION
+    r = cache.unmarshal(b)
+    assert r == v
+    assert type(r["data"]) is ZeroCopyByteArray
+
+
+def test_unmarshal_out_of_band_buffers_writable(cache):
+    v = BufferView(bytearray(os.urandom(4096)))
+    b = cache.marshal(v)
+    assert b[-1:] == PICKLE_BUFFERS_SUFFIX
+    r = cache.unmarshal(b)
+    assert not r.view.readonly
+    assert r.view == v.view
+
+
+def test_marshal_small_buffer_in_band(cache):
+    v = {"data": ZeroCopyByteArray(b"abc")}
+    b = cache.marshal(v)
+    assert b[-1:] == OTHER_SUFFIX
+    assert cache.unmarshal(b) == v
 
 
 def test_get_bytes(cache):
@@ -137,6 +305,25 @@ def test_get_int(cache):
     assert r == v
 
 
+@pytest.mark.parametrize("v", [0, "", [], False])
+def test_get_falsy_value(cache, v):
+    item = Item("k", v)
+    assert cache.set(item)
+    assert cache.get("k") == v
+
+
+def test_set_calls_do_func_once(cache):
+    calls = []
+
+    def do(item):
+        calls.append(item.key)
+        return "v"
+
+    cache.set(Item("k", "", do_func=do))
+    assert calls == ["k"]
+    assert cache.get("k") == "v"
+
+
 def test_get_tuple(cache):
     v = (1,)
     item = Item("k", v)
@@ -177,6 +364,123 @@ def test_get_by_skipping_local_cache(cache):
     assert err_msg == "cache: key is missing"
 
 
+def test_get_expired_from_local_cache(cache, monkeypatch):
+    now = time.time()
+    cache.set(Item("k", "v"))
+    assert cache.get("k") == "v"
+    monkeypatch.setattr(time, "time", lambda: now + cache.opt.local_cache_ttl + 1)
+    with pytest.raises(CacheMissError):
+        cache.get("k")
+
+
+def test_stats(redis_cache):
+    redis_cache.set(Item("k", "v"))
+    assert redis_cache.get("k", skip_local_cache=True) == "v"
+    assert redis_cache.get("foo") is None
+    stats = redis_cache.stats()
+    assert stats.hits == 1
+    assert stats.misses == 1
+    stats = redis_cache.stats()
+    assert stats.hits == 1
+    assert stats.misses == 1
+    assert redis_cache.hits == 1
+    assert redis_cache.hits == 1
+
+    redis_cache.hits = 0
+    redis_cache.misses = 5
+    assert redis_cache.get("k", skip_local_cache=True) == "v"
+    assert redis_cache.stats() == {"hits": 1, "misses": 5}
+
+
+def test_stats_initial_counters():
+    cache = Cache(Option(redis=DictRedis(), stats_enabled=True), hits=3, misses=4)
+    assert cache.get("foo") is None
+    assert cache.stats() == {"hits": 3, "misses": 5}
+
+
+def test_stats_disabled():
+    cache = Cache(Option(redis=DictRedis()))
+    assert cache.get("foo") is None
+    assert cache.stats() is None
+    assert cache.misses == 0
+
+
+def test_local_cache_evicts_least_recently_used():
+    lc = LocalCache(maxsize=2)
+    lc.add("a", 1)
+    lc.add("b", 2)
+    assert lc.get("a") == 1
+    lc.add("c", 3)
+    assert lc.get("b") is None
+    assert lc.get("a") == 1
+    assert lc.get("c") == 3
+    assert lc.delete("a") == 1
+    assert lc.delete("a") == 0
+    assert len(lc) == 1
+
+
+def test_mset_mget(redis_cache):
+    redis_cache.mset([Item("a", "v1"), Item("b", 2), Item("c", [3])])
+    assert redis_cache.mget(["a", "b", "c", "d"]) == ["v1", 2, [3], None]
+    assert redis_cache.mget(["a", "d"], skip_local_cache=True) == ["v1", None]
+    stats = redis_cache.stats()
+    assert stats.hits == 1
+    assert stats.misses == 2
+
+
+def test_mset_with_redis_py_client():
+    redis = PyRedisLike()
+    cache = Cache(Option(redis=redis))
+    assert cache.mset([Item("a", "v1"), Item("b", 2)])
+    assert redis.executed == 1
+    assert cache.mget(["a", "b", "c"], skip_local_cache=True) == ["v1", 2, None]
+
+
+def test_mset_with_client_without_pipeline():
+    redis = MappingMsetRedis()
+    cache = Cache(Option(redis=redis))
+    assert cache.mset([Item("a", "v1"), Item("b", 2)])
+    assert cache.mget(["a", "b"], skip_local_cache=True) == ["v1", 2]
+
+
+def test_mget_with_client_without_mget():
+    class GetSetRedis:
+        def __init__(self):
+            self.data = {}
+
+        def set(self, key, value, expiration):
+            self.data[key] = value
+
+        def get(self, key):
+            return self.data.get(key)
+
+        def delete(self, *key):
+            return sum(1 for k in key if self.data.pop(k, None) is not None)
+
+    cache = Cache(Option(redis=GetSetRedis()))
+    assert cache.mset([Item("a", "v1"), Item("b", 2)])
+    assert cache.mget(["a", "b", "c"], skip_local_cache=True) == ["v1", 2, None]
+
+
+def test_mset_mget_without_redis(cache):
+    cache.mset([Item("a", "v1"), Item("b", "v2")])
+    assert cache.mget(["a", "b", "c"]) == ["v1", "v2", None]
+
+
+def test_encode_decode_time():
+    now = int(time.time())
+    b = encode_time(now)
+    assert len(b) == 4
+    assert decode_time(b) == now
+
+
+def test_option_keeps_custom_local_cache():
+    lc = LocalCache(maxsize=2)
+    opt = Option(local_cache=lc)
+    assert opt.local_cache is lc
+    assert opt.local_cache.maxsize == 2
+
+
 def test_redis_interface_error(cache):
     bad_redis = RedisIface()
     opt = Option(redis=bad_redis, local_cache=None)
@@ -202,3 +506,75 @@ def test_cache_once(cache):
     cache.once(item2)
     assert item2.value == "v1"
 
+
+def test_cache_once_miss_calls_do_func(redis_cache):
+    calls = []
+
+    def do(item):
+        calls.append(item.key)
+        return "v"
+
+    item = Item("k", "", do_func=do)
+    assert redis_cache.once(item) == "v"
+    assert calls == ["k"]
+    assert redis_cache.get("k") == "v"
+
+    assert redis_cache.once(Item("k", "", do_func=do)) == "v"
+    assert calls == ["k"]
+
+
+def test_cache_once_skip_local_cache_without_redis(cache):
+    calls = []
+
+    def do(item):
+        calls.append(item.key)
+        return "v"
+
+    for _ in range(2):
+        item = Item("k", "", do_func=do, skip_local_cache=True)
+        assert cache.once(item) == "v"
+    assert calls == ["k"]
+
+
+def test_set_get_item_bytes_once(redis_cache):
+    b, cached = redis_cache.set_get_item_bytes_once(Item("k", "v"))
+    assert not cached
+    assert redis_cache.unmarshal(b) == "v"
+    b, cached = redis_cache.set_get_item_bytes_once(Item("k", "other"))
+    assert cached
+    assert redis_cache.unmarshal(b) == "v"
+
+
+def test_cache_once_redis_get_error():
+    class BrokenGetRedis(DictRedis):
+        def get(self, key):
+            raise ConnectionError("redis is down")
+
+    redis = BrokenGetRedis()
+    cache = Cache(Option(redis=redis))
+    item = Item("k", "", do_func=lambda item: "v", skip_local_cache=True)
+    assert cache.once(item) == "v"
+    assert cache.unmarshal(redis.data["k"]) == "v"
+
+
+def test_cache_once_single_flight(redis_cache):
+    calls = []
+
+    def do(item):
+        calls.append(item.key)
+        time.sleep(0.05)
+        return "v"
+
+    results = []
+
+    def run():
+        results.append(redis_cache.once(Item("k", "", do_func=do)))
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == ["k"]
+    assert results == ["v"] * 4
+    assert redis_cache._keylocks == {}
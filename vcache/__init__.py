@@ -1,21 +1,131 @@
 # coding: utf-8
 
 import pickle
+import struct
 import zlib
 import time
-from datetime import datetime
-from threading import RLock
-from cacheout import Cache as LocalCache
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # lz4 is optional, fall back to zlib
+    lz4_frame = None
 
 LOCAL_CACHE_MAX_SIZE = 256
 COMPRESSION_THRESHOLD = 64
+PICKLE_BUFFER_THRESHOLD = 1024
+ZLIB_COMPRESSION_LEVEL = 1
 ONE_MINUTE = 60
 ONE_HOUR = ONE_MINUTE * 60
 NO_COMPRESSION = b"\x00"
 ZLIB_COMPRESSION = b"\x01"
+LZ4_COMPRESSION = b"\x02"
+ZLIB_RAW_COMPRESSION = b"\x03"
 BYTES_SUFFIX = b"\x00"
 STR_SUFFIX = b"\x01"
 OTHER_SUFFIX = b"\x02"
+INT_SUFFIX = b"\x03"
+FLOAT_SUFFIX = b"\x04"
+BOOL_SUFFIX = b"\x05"
+PICKLE_BUFFERS_SUFFIX = b"\x06"
+
+_INT_STRUCT = struct.Struct("<q")
+_FLOAT_STRUCT = struct.Struct("<d")
+_COUNT_STRUCT = struct.Struct("<I")
+
+
+def _marshal_bytes(value):
+    return b"".join((value, BYTES_SUFFIX))
+
+
+def _marshal_str(value):
+    return b"".join((value.encode("utf-8"), STR_SUFFIX))
+
+
+def _marshal_int(value):
+    try:
+        return b"".join((_INT_STRUCT.pack(value), INT_SUFFIX))
+    except struct.error:
+        # does not fit in 64 bits, leave it to pickle
+        return None
+
+
+def _marshal_float(value):
+    return b"".join((_FLOAT_STRUCT.pack(value), FLOAT_SUFFIX))
+
+
+def _marshal_bool(value):
+    return b"".join((b"\x01" if value else b"\x00", BOOL_SUFFIX))
+
+
+# marshal functions for the types that are stored without pickle, a
+# function may return None to fall back to pickle.
+_MARSHAL_DISPATCH = {
+    bytes: _marshal_bytes,
+    str: _marshal_str,
+    int: _marshal_int,
+    float: _marshal_float,
+    bool: _marshal_bool,
+}
+
+
+def _pickle_dumps(value):
+    """Pickle value, returning the stream and its out-of-band buffers.
+
+    With protocol 5, large buffers exposed through pickle.PickleBuffer
+    (e.g. numpy arrays) are kept out of the pickle stream, so they are
+    neither copied into it nor scanned by the compressor.
+    """
+    if pickle.HIGHEST_PROTOCOL < 5:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), []
+
+    buffers = []
+
+    def buffer_callback(buf):
+        # a true return value keeps the buffer in-band
+        if memoryview(buf).nbytes < PICKLE_BUFFER_THRESHOLD:
+            return True
+        try:
+            buffers.append(buf.raw())
+        except BufferError:  # not contiguous
+            return True
+
+    b = pickle.dumps(
+        value, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffer_callback
+    )
+    return b, buffers
+
+
+def _pack_buffers(stream, buffers):
+    # layout: count | len(stream) len(buf1) ... | stream | buf1 | ...
+    parts = [
+        _COUNT_STRUCT.pack(len(buffers)),
+        struct.pack("<%dQ" % (len(buffers) + 1), len(stream), *map(len, buffers)),
+        stream,
+    ]
+    parts.extend(buffers)
+    return parts
+
+
+def _unpack_buffers(mv):
+    n = _COUNT_STRUCT.unpack_from(mv)[0]
+    offset = _COUNT_STRUCT.size
+    lengths = struct.unpack_from("<%dQ" % (n + 1), mv, offset)
+    offset += 8 * (n + 1)
+
+    stream = mv[offset : offset + lengths[0]]
+    offset += lengths[0]
+
+    # copy the buffers so objects rebuilt on top of them (e.g. numpy
+    # arrays) are writable and do not keep the whole payload alive.
+    buffers = []
+    for length in lengths[1:]:
+        buffers.append(bytearray(mv[offset : offset + length]))
+        offset += length
+    return stream, buffers
 
 
 class AttrDict(dict):
@@ -72,6 +182,18 @@ class RedisIface:
             "cache:not implement 'delete' method in RedisIface sub class"
         )
 
+    # mget returns the values of keys in order, None for missing keys.
+    # Override it to fetch all keys in one round trip (e.g. MGET).
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    # mset_ex sets (key, value, expiration) triples. Override it to send
+    # them in one round trip (e.g. a pipeline). It is not named mset because
+    # redis-py's mset takes a mapping and no expiration.
+    def mset_ex(self, items):
+        for key, value, expiration in items:
+            self.set(key, value, expiration)
+
 
 class Item:
     def __init__(
@@ -109,7 +231,7 @@ class Item:
         ret = None
         if self.do:
             ret = self.do(self)
-        elif self._value:
+        elif self._value is not None:
             ret = self._value
         return ret
 
@@ -131,13 +253,56 @@ class Item:
     ttl = property(get_ttl, set_ttl)
 
 
+class LocalCache:
+    """A minimal thread-safe LRU cache used as the default local_cache.
+
+    Expiration is handled by Cache itself, so this only keeps the most
+    recently used ``maxsize`` entries in an OrderedDict.
+    """
+
+    def __init__(self, maxsize=LOCAL_CACHE_MAX_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, default)
+            if value is not default:
+                self._data.move_to_end(key)
+            return value
+
+    def add(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            return 1 if self._data.pop(key, None) is not None else 0
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
 class Option:
     def __init__(
         self, redis=None, local_cache=None, local_cache_ttl=0, stats_enabled=False
     ):
         self.redis = redis
         self.local_cache = (
-            local_cache if local_cache else LocalCache(maxsize=LOCAL_CACHE_MAX_SIZE)
+            local_cache
+            if local_cache is not None
+            else LocalCache(maxsize=LOCAL_CACHE_MAX_SIZE)
         )
         if local_cache_ttl < 0:
             self.local_cache_ttl = 0
@@ -149,23 +314,59 @@ class Option:
         self.stats_enabled = stats_enabled
 
 
+class _Counter:
+    """A counter that is incremented without taking a lock.
+
+    next() on an itertools.count is atomic under the GIL, but the count
+    can only be read by advancing it, so value() also counts its own reads
+    and subtracts them.
+    """
+
+    def __init__(self, start=0):
+        self._count = count()
+        self._start = start
+        self._reads = 0
+        self._lock = Lock()
+        self.incr = self._count.__next__
+
+    def value(self):
+        with self._lock:
+            n = next(self._count) - self._reads + self._start
+            self._reads += 1
+            return n
+
+
 class Cache:
+    # compressed payloads larger than this ratio of the original are
+    # stored uncompressed.
+    COMPRESSION_MIN_RATIO = 0.9
+
     def __init__(self, opt=None, hits=0, misses=0):
         self.opt = opt if opt else Option()
-        self.hits = hits
-        self.misses = misses
-        self._lock = RLock()
+        self._hits = _Counter(hits)
+        self._misses = _Counter(misses)
+        # _lock guards _keylocks, which maps a key to [lock, users] for the
+        # callers of once() currently working on that key.
+        self._lock = Lock()
+        self._keylocks = {}
 
     def set(self, item):
-        if item.value is None:
+        value = item.value
+        if value is None:
             raise ValueError("cache:value is None")
 
-        b = self.marshal(item.value)
-        if self.opt.local_cache is not None:
+        return self._set_bytes(item, self.marshal(value))
+
+    def _set_bytes(self, item, b):
+        opt = self.opt
+        local_cache = opt.local_cache
+        redis = opt.redis
+
+        if local_cache is not None:
             self.local_set(item.key, b)
 
-        if self.opt.redis is None:
-            if self.opt.local_cache is None:
+        if redis is None:
+            if local_cache is None:
                 raise RedisLocalCacheNoneError
             return True
 
@@ -176,13 +377,69 @@ class Cache:
             set_func = "setnx"
 
         try:
-            getattr(self.opt.redis, set_func)(item.key, b, item.ttl)
+            getattr(redis, set_func)(item.key, b, item.ttl)
             return True
         except NotImplementedError:
             raise
         except Exception as e:
             raise RedisIfaceError("cache: redis '%s' error. %s" % (set_func, str(e)))
 
+    def mset(self, items):
+        batch = []
+        for item in items:
+            if item.if_exists or item.if_not_exists:
+                # conditional sets have no batched form
+                self.set(item)
+                continue
+
+            value = item.value
+            if value is None:
+                raise ValueError("cache:value is None")
+            b = self.marshal(value)
+            if self.opt.local_cache is not None:
+                self.local_set(item.key, b)
+            batch.append((item.key, b, item.ttl))
+
+        if self.opt.redis is None:
+            if self.opt.local_cache is None:
+                raise RedisLocalCacheNoneError
+            return True
+        if not batch:
+            return True
+
+        try:
+            self._redis_mset_ex(batch)
+            return True
+        except NotImplementedError:
+            raise
+        except Exception as e:
+            raise RedisIfaceError("cache: redis 'mset' error. %s" % str(e))
+
+    def _redis_mset_ex(self, batch):
+        redis = self.opt.redis
+        if hasattr(redis, "mset_ex"):
+            redis.mset_ex(batch)
+        elif hasattr(redis, "pipeline"):
+            # e.g. a redis-py client
+            pipe = redis.pipeline()
+            for key, b, ttl in batch:
+                pipe.set(key, b, ttl)
+            pipe.execute()
+        else:
+            for key, b, ttl in batch:
+                redis.set(key, b, ttl)
+
+    def _redis_mget(self, keys):
+        redis = self.opt.redis
+        if hasattr(redis, "mget"):
+            return redis.mget(keys)
+        elif hasattr(redis, "pipeline"):
+            pipe = redis.pipeline()
+            for key in keys:
+                pipe.get(key)
+            return pipe.execute()
+        return [redis.get(key) for key in keys]
+
     def get_skipping_local_cache(self, key):
         return self.get(key, True)
 
@@ -190,22 +447,84 @@ class Cache:
         b = self._get_bytes(key, skip_local_cache)
         return self.unmarshal(b)
 
+    def mget(self, keys, skip_local_cache=False):
+        return [self.unmarshal(b) for b in self._mget_bytes(keys, skip_local_cache)]
+
     # Once gets the item.Value for the given item.Key from the cache or
     # executes, caches, and returns the results of the given item.Func,
     # making sure that only one execution is in-flight for a given item.Key
     # at a time. If a duplicate comes in, the duplicate caller waits for the
     # original to complete and receives the same results.
     def once(self, item):
-        b, cached = self.set_get_item_bytes_once(item)
-        if not b:
+        with self._key_lock(item.key):
+            b = self._get_item_bytes(item)
+            if b is not None:
+                try:
+                    value = self.unmarshal(b)
+                except Exception:
+                    # the cached bytes are unreadable, replace them below
+                    try:
+                        self.delete(item.key)
+                    except CacheMissError:
+                        pass
+                else:
+                    # hand the cached value back through the item as well;
+                    # note item.value keeps calling do_func when one is set.
+                    item.value = value
+                    return value
+
+            value = item.value
+            if value is None:
+                return None
+            self._set_bytes(item, self.marshal(value))
+            return value
+
+    def set_get_item_bytes_once(self, item):
+        """Return (bytes, cached) for item, setting it on a cache miss.
+
+        Kept for compatibility, once() returns the unmarshalled value.
+        """
+        try:
+            with self._key_lock(item.key):
+                b = self._get_item_bytes(item)
+                if b is not None:
+                    return b, True
+                value = item.value
+                if value is None:
+                    return None, False
+                b = self.marshal(value)
+                self._set_bytes(item, b)
+                return b, False
+        except Exception:
+            return None, False
+
+    def _get_item_bytes(self, item):
+        # without redis the local cache is the only copy, so it is read
+        # even when the item asks to skip it.
+        skip_local_cache = item.skip_local_cache and self.opt.redis is not None
+        try:
+            return self._get_bytes(item.key, skip_local_cache)
+        except (CacheMissError, RedisIfaceError):
+            # a failed read is treated as a miss, the value is computed and
+            # set again; errors from that set are not swallowed.
             return None
 
+    @contextmanager
+    def _key_lock(self, key):
+        with self._lock:
+            entry = self._keylocks.get(key)
+            if entry is None:
+                entry = self._keylocks[key] = [Lock(), 0]
+            entry[1] += 1
+
         try:
-            item.value = self.unmarshal(b)
-        except:
-            if cached:
-                self.delete(item.key)
-                return self.once(item)
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._keylocks[key]
 
     def delete(self, key):
         if self.opt.local_cache is not None:
@@ -221,139 +540,217 @@ class Cache:
             raise CacheMissError
         return True
 
-    def set_get_item_bytes_once(self, item):
-        if self.opt.local_cache is not None:
-            b = self.local_get(item.key)
-            return b, True
-
-        def do_func():
-            b = self._get_bytes(item.key, item.skip_local_cache)
-            if b is not None:
-                return b, True
-            b = self.set(item)
-            return b, False
-
-        try:
-            with self._lock:
-                return do_func()
-        except:
-            return None, False
-
     def _get_bytes(self, key, skip_local_cache=False):
-        if not skip_local_cache and self.opt.local_cache is not None:
+        opt = self.opt
+        local_cache = opt.local_cache
+        redis = opt.redis
+        stats_enabled = opt.stats_enabled
+
+        if not skip_local_cache and local_cache is not None:
             b = self.local_get(key)
             if b is not None:
                 return b
 
-        if self.opt.redis is None:
-            if self.opt.local_cache is None:
+        if redis is None:
+            if local_cache is None:
                 raise RedisLocalCacheNoneError
             raise CacheMissError
 
         try:
-            b = self.opt.redis.get(key)
+            b = redis.get(key)
         except Exception as e:
-            if self.opt.stats_enabled:
-                with self._lock:
-                    self.misses += 1
+            if stats_enabled:
+                self._misses.incr()
             raise RedisIfaceError("cache: redis 'get' error. %s" % str(e))
 
+        if stats_enabled:
+            (self._misses if b is None else self._hits).incr()
+
         if b is None:
-            with self._lock:
-                    self.misses += 1
             return None
 
-        if self.opt.stats_enabled:
-            with self._lock:
-                self.hits += 1
-
-        if not skip_local_cache and self.opt.local_cache is not None:
+        if not skip_local_cache and local_cache is not None:
             self.local_set(key, b)
         return b
 
+    def _mget_bytes(self, keys, skip_local_cache=False):
+        keys = list(keys)
+        use_local_cache = not skip_local_cache and self.opt.local_cache is not None
+        result = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            b = self.local_get(key) if use_local_cache else None
+            if b is None:
+                missing.append(i)
+            else:
+                result[i] = b
+
+        if not missing:
+            return result
+        if self.opt.redis is None:
+            if self.opt.local_cache is None:
+                raise RedisLocalCacheNoneError
+            return result
+
+        try:
+            values = self._redis_mget([keys[i] for i in missing])
+        except NotImplementedError:
+            raise
+        except Exception as e:
+            if self.opt.stats_enabled:
+                for _ in missing:
+                    self._misses.incr()
+            raise RedisIfaceError("cache: redis 'mget' error. %s" % str(e))
+
+        for i, b in zip(missing, values):
+            if self.opt.stats_enabled:
+                (self._misses if b is None else self._hits).incr()
+            if b is None:
+                continue
+            result[i] = b
+            if use_local_cache:
+                self.local_set(keys[i], b)
+        return result
+
     def marshal(self, value):
         if value is None:
             return None
-        
-        value_type = type(value)
-        if value_type is bytes:
-            return value + BYTES_SUFFIX
-        elif value_type is str:
-            return bytes(value, encoding="utf-8") + STR_SUFFIX
-
-        b = pickle.dumps(value)
+
+        fn = _MARSHAL_DISPATCH.get(type(value))
+        if fn is not None:
+            b = fn(value)
+            if b is not None:
+                return b
+
+        # pickle.dumps and the compressors allocate their output at its final
+        # size; staging it in a reusable per-thread buffer only adds a copy.
+        b, buffers = _pickle_dumps(value)
+        b, compression = self._compress(b)
+        if not buffers:
+            return b"".join((b, compression, OTHER_SUFFIX))
+
+        parts = _pack_buffers(b, buffers)
+        parts.append(compression)
+        parts.append(PICKLE_BUFFERS_SUFFIX)
+        return b"".join(parts)
+
+    def _compress(self, b):
         if len(b) < COMPRESSION_THRESHOLD:
-            b = b + NO_COMPRESSION + OTHER_SUFFIX
-            return b
+            return b, NO_COMPRESSION
 
-        b = zlib.compress(b)
-        b = b + ZLIB_COMPRESSION + OTHER_SUFFIX
-        return b
+        if lz4_frame is not None:
+            c = lz4_frame.compress(b, compression_level=0)
+            compression = LZ4_COMPRESSION
+        else:
+            # raw deflate, the suffix bytes already frame the payload so
+            # the zlib header and checksum are not needed.
+            co = zlib.compressobj(ZLIB_COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+            c = b"".join((co.compress(b), co.flush()))
+            compression = ZLIB_RAW_COMPRESSION
+
+        # keep incompressible payloads as they are, so that reading them
+        # back does not pay for a useless decompression.
+        if len(c) > len(b) * self.COMPRESSION_MIN_RATIO:
+            return b, NO_COMPRESSION
+        return c, compression
 
     def unmarshal(self, b):
         if b is None or len(b) == 0:
             return None
 
+        # slice through a memoryview so stripping the suffixes does not
+        # copy the payload; single-byte bytes slices are cached by CPython.
         type_suffix = b[-1:]
-        b = b[:-1]
+        mv = memoryview(b)[:-1]
         if type_suffix == BYTES_SUFFIX:
-            return b
+            return bytes(mv)
         elif type_suffix == STR_SUFFIX:
-            return b.decode(encoding="utf-8")
-
-        if len(b) == 0:
+            return str(mv, encoding="utf-8")
+        elif type_suffix == INT_SUFFIX:
+            return _INT_STRUCT.unpack(mv)[0]
+        elif type_suffix == FLOAT_SUFFIX:
+            return _FLOAT_STRUCT.unpack(mv)[0]
+        elif type_suffix == BOOL_SUFFIX:
+            return mv == b"\x01"
+
+        if len(mv) == 0:
             return None
 
-        compression = b[-1:]
-        b = b[:-1]
+        compression = b[-2:-1]
+        b = mv[:-1]
+        buffers = None
+        if type_suffix == PICKLE_BUFFERS_SUFFIX:
+            # only the pickle stream is compressed, never the buffers
+            b, buffers = _unpack_buffers(b)
+
         if compression == NO_COMPRESSION:
             pass
+        elif compression == ZLIB_RAW_COMPRESSION:
+            b = zlib.decompress(b, -15)
         elif compression == ZLIB_COMPRESSION:
             b = zlib.decompress(b)
+        elif compression == LZ4_COMPRESSION:
+            if lz4_frame is None:
+                raise UnkownCompressionError("lz4 is not installed:", compression)
+            b = lz4_frame.decompress(b)
         else:
             raise UnkownCompressionError("uknownn compression method:", compression)
 
+        if buffers is not None:
+            return pickle.loads(b, buffers=buffers)
         return pickle.loads(b)
 
     def local_set(self, key, b):
-        if self.opt.local_cache_ttl > 0:
-            b += encode_time(datetime.now())
-        self.opt.local_cache.add(key, b)
+        # the write time is kept next to the payload rather than appended
+        # to it, so local_get can return the stored bytes as they are.
+        self.opt.local_cache.add(key, (b, int(time.time())))
 
     def local_get(self, key):
-        b = self.opt.local_cache.get(key)
-        if b is None:
+        local_cache = self.opt.local_cache
+        entry = local_cache.get(key)
+        if entry is None:
             return None
-        if len(b) == 0 or self.opt.local_cache_ttl == 0:
-            return b
-        if len(b) < 4:
-            raise Exception("not reached")
-
-        dt = decode_time(b[-4:])
-        now = datetime.now()
-        if (now - dt).seconds > self.opt.local_cache_ttl:
-            self.opt.local_cache.delete(key)
+
+        b, created = entry
+        ttl = self.opt.local_cache_ttl
+        if ttl > 0 and int(time.time()) - created > ttl:
+            local_cache.delete(key)
             return None
-        return b[:-4]
+        return b
 
     def stats(self):
         if not self.opt.stats_enabled:
             return None
-        with self._lock:
-            return AttrDict(hits=self.hits, misses=self.misses)
+        return AttrDict(hits=self.hits, misses=self.misses)
 
+    # hits and misses can be assigned, e.g. cache.hits = 0 resets them.
+    @property
+    def hits(self):
+        return self._hits.value()
 
-# ------ utils functions
-EPOCH = int(datetime.timestamp(datetime(2020, 1, 1)))
+    @hits.setter
+    def hits(self, n):
+        self._hits = _Counter(n)
 
+    @property
+    def misses(self):
+        return self._misses.value()
 
-def encode_time(dt):
-    secs = int(datetime.timestamp(dt)) - EPOCH
-    return secs.to_bytes(4, byteorder="little", signed=True)
+    @misses.setter
+    def misses(self, n):
+        self._misses = _Counter(n)
 
 
-def decode_time(b):
-    secs = int.from_bytes(b, byteorder="little", signed=True)
-    return datetime.fromtimestamp(EPOCH + secs)
+# ------ utils functions
+EPOCH = int(time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1)))
+_TIME_STRUCT = struct.Struct("<i")
+
 
+def encode_time(secs=None):
+    if secs is None:
+        secs = int(time.time())
+    return _TIME_STRUCT.pack(secs - EPOCH)
 
+
+def decode_time(b):
+    return EPOCH + _TIME_STRUCT.unpack(b)[0]